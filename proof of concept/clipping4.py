@@ -22,215 +22,338 @@ import numpy as np
 import matplotlib.pyplot as plt
 import mpl_toolkits.mplot3d as a3
 from scipy.spatial import ConvexHull
-from itertools import combinations, count
+from math import sqrt
 import timeit
-import copy
 import time
 
-epsilon = 1e-10
-
-def update_edge(edge, p, n):
-    v1 = edge[0]
-    v2 = edge[1]
-
-    # Normal component wrt plane
-    v1_normal = np.dot(v1-p,n)
-    v2_normal = np.dot(v2-p,n)
-
-    if v1_normal > -epsilon and v2_normal > -epsilon:
-        return None, None
+try:
+    from numba import njit
+    has_numba = True
+except ImportError:
+    has_numba = False
 
-    if v1_normal <= -epsilon and v2_normal <= -epsilon:
-        return edge, None
-
-    if v1_normal > -epsilon and v1_normal <= epsilon: # in plane
-        return edge, v1
-
-    if v2_normal > -epsilon and v2_normal <= epsilon: # in plane
-        return edge, v2
+epsilon = 1e-10
 
-    edge_normal = np.dot(v2-v1,n)
-    alpha = -v1_normal / edge_normal
-    v_new = v1 + alpha*(v2-v1)
+# Enables consistency assertions in the clip hot path (python -O strips
+# them regardless)
+_SLOW_CHECKS = False
 
-    if v1_normal > epsilon:
-        edge[0] = v_new
-    else:
-        edge[1] = v_new
+def _dot3(a, b):
+    # np.dot costs far more in dispatch than in FLOPs for 3-vectors
+    return a[0]*b[0] + a[1]*b[1] + a[2]*b[2]
 
-    assert edge_length(edge)>epsilon
+def _cross3(a, b):
+    return (a[1]*b[2] - a[2]*b[1],
+            a[2]*b[0] - a[0]*b[2],
+            a[0]*b[1] - a[1]*b[0])
 
-    return edge, v_new
+def update_face(face, n, pn):
+    """
+    Sutherland-Hodgman clipping of one face (a (V,3) array of vertices in
+    ring order) against the plane with normal n and offset pn = p@n.
+    Returns the clipped ring along with an (N,3) array of the vertices
+    where edges crossed the plane.
+    """
+    # normal component of each vertex wrt plane; einsum avoids the
+    # temporary a plain (face*n).sum(-1) would build
+    d = np.einsum('ij,j->i', face, n) - pn
+
+    inside = d <= -epsilon
+    if inside.all():
+        return face, np.empty((0,3))
+    if not inside.any():
+        return face[:0], np.empty((0,3))
+
+    d_next = np.roll(d, -1)
+    face_next = np.roll(face, -1, axis=0)
+    crossing = inside ^ np.roll(inside, -1)
+
+    cross_ids = np.flatnonzero(crossing)
+    alpha = -d[cross_ids] / (d_next[cross_ids]-d[cross_ids])
+    # An endpoint within epsilon of the plane clips to (nearly) itself.
+    # Clamping alpha makes that exact also when the denominator is tiny.
+    np.clip(alpha, 0.0, 1.0, out=alpha)
+    v_new = face[cross_ids] + alpha[:,None]*(face_next[cross_ids]-face[cross_ids])
+
+    # Each vertex emits itself if inside, then the intersection point if its
+    # outgoing edge crosses the plane. Scatter both into the output ring.
+    emits = inside.astype(np.intp) + crossing
+    offsets = np.cumsum(emits) - emits
+    out = np.empty((emits.sum(),3))
+    out[offsets[inside]] = face[inside]
+    out[offsets[cross_ids] + inside[cross_ids]] = v_new
+
+    return out, v_new
+
+if has_numba:
+
+    # Module-level so the compiled dispatchers are created (or loaded from
+    # cache) once and reused for every clip.
+
+    @njit(cache=True, fastmath=True)
+    def _update_face_nb(face, n, pn, out_face, out_new):
+        """
+        Numba version of update_face. Writes the clipped ring to out_face and
+        crossing vertices to out_new (both preallocated) and returns how many
+        rows of each were filled. Returns n_out=-1 without touching the
+        buffers when the face lies entirely behind the plane.
+        """
+        V = face.shape[0]
+        d = np.empty(V)
+        inside = np.empty(V, dtype=np.bool_)
+        n_inside = 0
+        for i in range(V):
+            d[i] = face[i,0]*n[0] + face[i,1]*n[1] + face[i,2]*n[2] - pn
+            inside[i] = d[i] <= -epsilon
+            if inside[i]:
+                n_inside += 1
+
+        # Most faces are either untouched or swallowed whole by a plane;
+        # skip the per-edge work for those.
+        if n_inside == V:
+            return -1, 0
+        if n_inside == 0:
+            return 0, 0
+
+        n_out = 0
+        n_new = 0
+        for i in range(V):
+            j = i+1 if i+1 < V else 0
+
+            if inside[i]:
+                for k in range(3):
+                    out_face[n_out,k] = face[i,k]
+                n_out += 1
+
+            if inside[i] ^ inside[j]:
+                alpha = -d[i] / (d[j]-d[i])
+                if alpha < 0.0: alpha = 0.0
+                if alpha > 1.0: alpha = 1.0
+                for k in range(3):
+                    v_new_k = face[i,k] + alpha*(face[j,k]-face[i,k])
+                    out_face[n_out,k] = v_new_k
+                    if n_new < out_new.shape[0]:
+                        out_new[n_new,k] = v_new_k
+                n_out += 1
+                n_new += 1
+
+        return n_out, n_new
+
+    @njit(cache=True, fastmath=True)
+    def _face_vertices_volume(face_vertices, a):
+        """
+        Sum of signed (unscaled) tetrahedron volumes of the fan from a over
+        the polygon face_vertices (a (V,3) array). Positive when the ring is
+        wound with its outward normal away from a.
+        """
+        volume = 0.0
+        b = face_vertices[0]
+        for i in range(1, face_vertices.shape[0]-1):
+            c = face_vertices[i]
+            d = face_vertices[i+1]
+            cx = (c[1]-d[1])*(b[2]-d[2]) - (c[2]-d[2])*(b[1]-d[1])
+            cy = (c[2]-d[2])*(b[0]-d[0]) - (c[0]-d[0])*(b[2]-d[2])
+            cz = (c[0]-d[0])*(b[1]-d[1]) - (c[1]-d[1])*(b[0]-d[0])
+            volume += (a[0]-d[0])*cx + (a[1]-d[1])*cy + (a[2]-d[2])*cz
+        return volume
 
 def is_behind_plane(point, p, n):
-    normal_component = np.dot(point-p,n)
+    normal_component = _dot3(point-p,n)
     return normal_component < 0
 
 
-# Vertex = [x,y]
-# Edge = [Vertex,Vertex] = [[x,y],[x,y]]
-# Face = [Edge,Edge,Edge,Edge] = [[[x,y],[x,y]],...]
-
-# No ID's, just storing vertices and edges directly nested.
-# Disadvantage: No re-using of already cut edges
-# Advantages: Does not need to keep track of edges.
-# It's likely cheaper to cut some edges twice than to book-keep
+# Vertex = row of 3 floats
+# Face = (V,3) array of its vertices in ring order
 
-def vertices_equal(a, b, tol=epsilon):
-    # just comparing a==b should be allright in this case since it's only
-    # copied values, however, it's better to produce safe code in case it's
-    # sometimes used differently.
-    return np.linalg.norm(a-b)<epsilon
-
-def vertex_in_list(vertex, edge, tol=epsilon):
-    return np.any([vertices_equal(a,vertex) for a in edge])
-
-def find_other_edge(face, edge, vertex):
-    """
-    Returns the other edge in face which shares this vertex.
-    """
-    for other_edge in face:
-        if other_edge is not edge:
-            if vertex_in_list(vertex, other_edge):
-                return other_edge
+# Each face is one contiguous float64 block; vertices are stored by value
+# (duplicated between faces) so there's nothing to book-keep. Keeping the
+# ring ordered means clipping is a single pass over the vertex array and
+# volume() can consume faces directly.
 
-def find_other_vertex(edge, vertex):
+def sort_face_vertices(vertices, n):
     """
-    Returns the other vertex of this edge.
+    Sorts coplanar points (an (N,3) array in a plane with normal n) into a
+    convex ring by their angle about the centroid, dropping duplicates.
+    The ring comes out counterclockwise as seen from the +n side, i.e.
+    wound with n as its outward normal.
     """
-    if np.all(edge[0]==vertex):
-        return edge[1]
-    else:
-        return edge[0]
-
-def extract_face_vertices(face):
-    face_vertices = []
-    edge = face[0]
-    vertex = edge[0]
-    first_vertex = vertex
-    while True:
-        face_vertices.append(vertex)
-        edge = find_other_edge(face, edge, vertex)
-        vertex = find_other_vertex(edge, vertex)
-        if vertex is first_vertex:
-            return face_vertices
-
-def flatten(inp):
-    output = []
-    for x in inp:
-        for y in x:
-            output.append(y)
-    return output
+    # In-plane basis built from the axis least aligned with n. (u,v,n) is
+    # right-handed, so ascending angle is counterclockwise about +n.
+    t = np.zeros(3)
+    t[np.argmin(np.abs(n))] = 1.0
+    u = np.cross(n, t)
+    v = np.cross(n, u)
+
+    rel = vertices - vertices.mean(0)
+    angle = np.arctan2(rel @ v, rel @ u)
+    vertices = vertices[np.argsort(angle)]
+
+    # The same intersection vertex is found once from each of the two faces
+    # sharing the crossing edge (with roundoff in the last bits). Duplicates
+    # are adjacent after sorting, so compare each vertex to its predecessor
+    # (cyclically) and keep the distinct ones.
+    diff = vertices - np.roll(vertices, 1, axis=0)
+    keep = np.einsum('ij,ij->i', diff, diff) >= epsilon*epsilon
+    return vertices[keep]
 
 def edge_length(edge):
-    return np.linalg.norm(edge[0]-edge[1])
+    d = edge[0]-edge[1]
+    return sqrt(_dot3(d,d))
+
+def _face_bbox(face):
+    return np.array((face.min(0), face.max(0)))
 
 class Polyhedron(object):
+
+    # Ring of the face opposite each vertex, as vertex indices. Wound so
+    # normals point outwards for a positively oriented tetrahedron.
+    face_rings = [[1,2,3],
+                  [0,3,2],
+                  [0,1,3],
+                  [0,2,1]]
+
     def __init__(self, *vertices):
 
         assert len(vertices)==4
 
-        vertices = [np.array(b,float) for b in vertices]
-
-        edges = list(combinations(vertices,2))
-        edges = [list(a) for a in edges]
+        vertices = np.array(vertices, dtype=np.float64)
 
-        # print(np.array(edges))
+        # face_rings assumes a positively oriented tetrahedron; swap two
+        # vertices if necessary so all face normals point outwards
+        if _dot3(_cross3(vertices[1]-vertices[0], vertices[2]-vertices[0]),
+                 vertices[3]-vertices[0]) < 0:
+            vertices = vertices[[0,1,3,2]]
 
-        self.faces = []
-        self.faces.append([3,4,5])
-        self.faces.append([1,2,5])
-        self.faces.append([0,2,4])
-        self.faces.append([0,1,3])
+        # Fancy indexing copies, so each face owns its (3,3) block
+        self.faces = [vertices[ring] for ring in self.face_rings]
+        self.face_bboxes = [_face_bbox(face) for face in self.faces]
 
-        for i,face in enumerate(self.faces):
-            for j,edge_id in enumerate(face):
-                self.faces[i][j] = copy.deepcopy(edges[edge_id])
+        # Reusable clip buffers, grown on demand
+        self._face_scratch = np.empty((8,3))
+        self._cap_scratch = np.empty((16,3))
 
     def __repr__(self):
         s = "Polyhedron\n\n"
         for i,f in enumerate(self.faces):
             s += "face %d:\n"%i
-            for j,e in enumerate(f):
-                s += "  edge " + str(j) + ": "
-                for v in e:
-                    s += str(v) + " "
-                s += "\n"
+            for j,v in enumerate(f):
+                s += "  vertex " + str(j) + ": " + str(v) + "\n"
             s += "\n"
         return s
 
-    def vertices_are_unique(self):
-        vertices = flatten(flatten(self.faces))
-        vertice_id = [id(v) for v in vertices]
-        n_total = len(vertice_id)
-        n_unique = len(set(vertice_id))
-        return n_total==n_unique
-
-    def vertex_coordinates_are_unique(self):
-        coords = flatten(flatten(flatten(self.faces)))
-        coord_id = [id(c) for c in coords]
-        n_total = len(coord_id)
-        n_unique = len(set(coord_id))
-        return n_total==n_unique
-
-    def extract_face_vertices(self):
-        faces = []
-        for face in self.faces:
-            faces.append(extract_face_vertices(face))
-        return faces
-
     def plot(self):
-        faces = self.extract_face_vertices()
         ax = a3.Axes3D(plt.figure())
-        tri = a3.art3d.Poly3DCollection(faces)
+        tri = a3.art3d.Poly3DCollection(self.faces)
         tri.set_alpha(0.3)
         ax.add_collection3d(tri)
         plt.show()
 
     def clip(self, p, n):
 
-        new_face = []
-        for face_id,face in reversed(zip(count(),self.faces)):
-
-            new_edge = []
-            for edge_id,edge in reversed(zip(count(),face)):
-
-                edge, new_vertex = update_edge(edge, p, n)
-
-                if edge is None:
-                    face.pop(edge_id)
-
-                if new_vertex is not None:
-                    new_edge.append(copy.deepcopy(new_vertex))
-
-            assert len(new_edge)==0 or len(new_edge)==2
+        # Coerce once so the kernels get stable C-contiguous float64
+        # buffers whatever the caller passed (lists, int arrays, views)
+        p = np.ascontiguousarray(p, dtype=np.float64)
+        n = np.ascontiguousarray(n, dtype=np.float64)
+
+        # pn is hoisted out of (v-p)@n = v@n - p@n
+        self._clip(n, _dot3(p, n))
+
+    def clip_many(self, p_arr, n_arr):
+        """
+        Clips by all P planes given as (P,3) arrays of points and normals.
+        Equivalent to calling clip once per plane, but the per-call setup
+        (argument conversion and plane offsets) is amortized over the batch.
+        """
+        p_arr = np.ascontiguousarray(p_arr, dtype=np.float64)
+        n_arr = np.ascontiguousarray(n_arr, dtype=np.float64)
+        pn_arr = np.einsum('ij,ij->i', p_arr, n_arr)
+        for i in range(len(n_arr)):
+            self._clip(n_arr[i], pn_arr[i])
+
+    def _clip(self, n, pn):
+
+        if len(self.faces)==0:
+            return
+
+        # Support of the plane on each face's bounding box: rejects faces
+        # wholly on one side of the plane with 6 multiplications per face,
+        # before any vertex is touched.
+        bboxes = np.array(self.face_bboxes)
+        support_min = np.einsum('ij,j->i', np.where(n>0, bboxes[:,0,:], bboxes[:,1,:]), n)
+        support_max = np.einsum('ij,j->i', np.where(n>0, bboxes[:,1,:], bboxes[:,0,:]), n)
+        box_inside = support_max <= pn - epsilon
+        box_outside = support_min > pn - epsilon
+
+        n_cap = 0
+        for face_id in range(len(self.faces)-1, -1, -1):
+            if box_inside[face_id]: # face entirely behind; untouched
+                continue
+            if box_outside[face_id]: # face entirely in front; drop
+                self.faces.pop(face_id)
+                self.face_bboxes.pop(face_id)
+                continue
+
+            face = self.faces[face_id]
+
+            if len(self._cap_scratch) < n_cap+2:
+                grown = np.empty((2*len(self._cap_scratch),3))
+                grown[:n_cap] = self._cap_scratch[:n_cap]
+                self._cap_scratch = grown
+
+            if has_numba:
+                if len(self._face_scratch) < len(face)+1:
+                    self._face_scratch = np.empty((2*len(face)+2,3))
+                out_new = self._cap_scratch[n_cap:n_cap+2]
+                n_kept, n_new = _update_face_nb(face, n, pn,
+                                                self._face_scratch, out_new)
+                if n_kept < 0: # face entirely behind the plane; untouched
+                    continue
+                # Copy out since the scratch buffer is reused
+                face = self._face_scratch[:n_kept].copy()
+                new_edge = out_new[:n_new]
+            else:
+                face, new_edge = update_face(face, n, pn)
+
+            if __debug__ and _SLOW_CHECKS:
+                assert len(new_edge)==0 or len(new_edge)==2
             if len(new_edge)==2 and edge_length(new_edge)>epsilon:
-                face.append(new_edge)
-                new_face.append(copy.deepcopy(new_edge))
+                self._cap_scratch[n_cap:n_cap+2] = new_edge
+                n_cap += 2
 
-            if face == []:
+            if len(face)<3:
                 self.faces.pop(face_id)
+                self.face_bboxes.pop(face_id)
+            else:
+                self.faces[face_id] = face
+                self.face_bboxes[face_id] = _face_bbox(face)
 
-        if len(new_face)>2:
-            self.faces.append(new_face)
-
-        assert self.vertices_are_unique()
+        if n_cap > 4: # at least three cap edges
+            new_face = sort_face_vertices(self._cap_scratch[:n_cap], n)
+            if len(new_face)>2:
+                self.faces.append(new_face)
+                self.face_bboxes.append(_face_bbox(new_face))
 
     def volume(self):
         if len(self.faces)==0: return 0.0
 
+        # Faces containing the reference vertex a only produce degenerate
+        # tetrahedra (zero volume), so no face needs to be skipped.
         volume = 0.0
-        a = self.faces[0][0][0]
+        a = self.faces[0][0]
         for face in self.faces:
-            face_vertices = extract_face_vertices(face)
-            if not vertex_in_list(a,face_vertices):
-                b = face_vertices[0]
-                for i in range(1,len(face_vertices)-1):
-                    c = face_vertices[i]
-                    d = face_vertices[i+1]
-                    cross = np.cross(b-d,c-d)
-                    dot = np.dot(a-d,cross)
-                    volume += abs(dot)
+            if has_numba:
+                volume += _face_vertices_volume(face, a)
+            else:
+                # Fan the ring into triangles and sum the signed
+                # tetrahedron volumes against a in one vectorized
+                # expression. Faces are wound consistently outwards,
+                # so the signs take care of themselves and no abs is
+                # needed.
+                b = face[0]
+                c = face[1:-1]
+                d = face[2:]
+                volume += np.einsum('ij,ij->i', a-d,
+                                    np.cross(c-d,b-d)).sum()
         volume *= (1.0/6)
         return volume
 
@@ -300,13 +423,11 @@ if __name__ == '__main__':
     p.clip([0,1,0],[0,1,0])
     p.clip([0,0,1],[0,0,1])
 
+    theta = np.arange(360) * np.pi / 180
+    planes = np.column_stack((np.cos(theta), np.sin(theta), np.zeros(360)))
+
     t0 = time.time()
-    for theta in range(0,360):
-        theta_rad = float(theta) * np.pi / 180
-        x = np.cos(theta_rad)
-        y = np.sin(theta_rad)
-        p.clip([x,y,0],[x,y,0])
-    # p.clip([0,0,0.3],[0,0,1])
+    p.clip_many(planes, planes)
     t1 = time.time()
     print("Cutting:",t1-t0)
     t0 = time.time()